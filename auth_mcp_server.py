@@ -3,22 +3,34 @@ FastMCP 2.0 server for Auth0 JWT token management.
 Provides tools for extracting and managing JWT tokens from Auth0 authentication.
 """
 
+import asyncio
+import copy
 import json
 import logging
+import multiprocessing
 import os
-from datetime import datetime
+import re
+import string
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any, Optional, List
-import requests
-from auth_playwright import AuthTokenExtractor, is_jwt_expired
+from types import MappingProxyType
+from typing import Dict, Any, Deque, Optional, List, Tuple
+import httpx
+from auth_playwright import close_extraction_worker, init_extraction_worker, jwt_exp, run_extraction_in_worker
 import jwt
 
-from pydantic import BaseModel
-
 from fastmcp import FastMCP
-from fastmcp.client.auth import BearerAuth
-# Import AuthTokenExtractor lazily to avoid initialization issues
-# from .auth_playwright_optimized import AuthTokenExtractor
+
+try:
+    import orjson
+except ImportError:  # optional speedup, fall back to stdlib json
+    orjson = None
 
 
 # Configure root logger
@@ -28,62 +40,350 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Sharp RMM API host; endpoints passed to _make_api_call are relative to it
+API_BASE_URL = "https://alt-rmm-api.sharpb2bcloud.com"
+
+# Firmware-update endpoints called by the device tools
+_EP_UPDATE_LIST = "/rmm/fss/fwupd/getFirmwareUpdateList"
+_EP_SET_OTA_MODE = "/stateful/fss/fwupd/setOTAMode"
+_EP_FIRMWARE_DATA_LIST = "/rmm/fss/fwupd/getFirmwareDataList"
+_EP_SET_RESERVATION = "/rmm/fss/fwupd/setUpdateReservation"
+_EP_REMOVE_RESERVATION = "/rmm/fss/fwupd/removeUpdateReservation"
+
+# Group used when neither the caller nor the JWT supplies one
+DEFAULT_GROUP_ID = "6d167a66-9c03-b981-6e37-8770c76676be"
+
+# Shared HTTP client so connections are pooled across tool calls
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Return the shared async HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=32)
+        )
+    return _http_client
+
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP):
+    """Flush buffered API call records when a client session ends.
+
+    Over SSE this runs once per client connection, so the shared HTTP client
+    and extraction worker are left alone here; see shutdown().
+    """
+    try:
+        yield
+    finally:
+        await token_manager.flush_api_calls()
+
+
+def shutdown() -> None:
+    """Process-exit teardown: flush the call log and stop the extraction worker.
+
+    Call this once after mcp.run() returns. The HTTP client is not closed
+    since its event loop is already gone; the OS reclaims its sockets.
+    """
+    token_manager.flush_api_calls_sync()
+    token_manager.close_executor()
+
+
 # Initialize FastMCP server
-mcp = FastMCP("Auth0 JWT Token Manager")
+mcp = FastMCP("Auth0 JWT Token Manager", lifespan=_lifespan)
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON bytes with orjson when available."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    """Serialize to compact JSON bytes with orjson when available."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _json_dumps_pretty(obj: Any) -> str:
+    """Serialize to indented JSON text with orjson when available."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+
+# Milliseconds one Playwright login may take before its worker is killed
+EXTRACTION_TIMEOUT = int(os.getenv('EXTRACTION_TIMEOUT', 180000))
+# Seconds to wait for the worker to close its browser at shutdown
+_WORKER_CLOSE_TIMEOUT = 10
+
+# Treat tokens as expired this many seconds before their actual `exp`
+TOKEN_EXPIRY_SKEW = 30
+
+
+def _is_token_valid(token: Optional[str]) -> bool:
+    """Check that a token is present and not about to expire."""
+    if not token or not token.strip():
+        return False
+    exp = jwt_exp(token)
+    return exp is not None and time.time() < exp - TOKEN_EXPIRY_SKEW
+
+
+def _stored_token(token_data: Dict[str, Any]) -> Optional[str]:
+    """Pull the JWT out of loaded token-file data, if present."""
+    extraction_result = token_data.get("token_extraction", {})
+    return extraction_result.get("token") if isinstance(extraction_result, dict) else None
+
+
+# Number of recent API calls kept in memory and exposed by get_token_file
+API_CALL_HISTORY_SIZE = 10
+# Bytes read per backward step when tailing the API call log
+_API_LOG_TAIL_CHUNK = 64 * 1024
+# Seconds to wait for more API call records before appending them to disk
+_API_LOG_FLUSH_DELAY = 0.5
+# The call log is rotated to api_calls.jsonl.1 (replacing any older one) past this size
+API_LOG_MAX_BYTES = 5 * 1024 * 1024
 
 class TokenManager:
     """Manages JWT token operations and storage"""
     
     def __init__(self):
-        self.token_file = os.path.join(Path(__file__).parent, "auth_token.json")
-        # Don't initialize extractor here to avoid event loop issues
-        self.extractor = None
+        self.token_file = Path(__file__).parent / "auth_token.json"
+        # Append-only log of API calls, kept out of the token file so it isn't rewritten per call
+        self.api_log_file = Path(__file__).parent / "api_calls.jsonl"
+        # Playwright runs in a dedicated worker process, started on first extraction
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Parsed token file keyed by (mtime_ns, size) so unchanged files aren't re-read
+        self._token_data_cache: Optional[Tuple[Tuple[int, int], Dict[str, Any]]] = None
+        # Only one Playwright login may run at a time
+        self._extraction_lock = asyncio.Lock()
+        # In-flight extraction shared by every caller that finds the token expired
+        self._extraction_task: Optional[asyncio.Task] = None
+        # Last token known to be valid, so hot paths can skip file I/O entirely
+        self._cached_token: Optional[str] = None
+        self._cached_exp: float = 0
+        # Recent API calls served from memory; new records are buffered and
+        # appended to the log file in batches by a background flush
+        self.api_calls: Deque[Dict[str, Any]] = deque(
+            self._read_api_log_tail(API_CALL_HISTORY_SIZE), maxlen=API_CALL_HISTORY_SIZE
+        )
+        self._pending_api_calls: List[bytes] = []
+        self._flush_task: Optional[asyncio.Task] = None
     
-    def get_extractor(self):
-        """Lazy initialization of the AuthTokenExtractor"""
-        if self.extractor is None:
-            self.extractor = AuthTokenExtractor()
-        return self.extractor
+    def get_executor(self) -> ProcessPoolExecutor:
+        """Lazy initialization of the single-worker Playwright process pool"""
+        if self._executor is None:
+            # Forking this threaded asyncio process is unsafe; forkserver starts the
+            # worker from a clean single-threaded server (Windows only has spawn)
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=init_extraction_worker
+            )
+        return self._executor
+
+    def discard_executor(self) -> None:
+        """Kill the Playwright worker without waiting; a fresh pool starts on next use"""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        # A hung login never returns, so the worker has to be killed outright
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close_executor(self) -> None:
+        """Close the worker's pooled browser and shut the process pool down (blocking)"""
+        if self._executor is None:
+            return
+        try:
+            self._executor.submit(close_extraction_worker).result(timeout=_WORKER_CLOSE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Failed to close extraction browser, killing worker: {e}")
+            self.discard_executor()
+            return
+        executor, self._executor = self._executor, None
+        executor.shutdown()
+
+    def get_cached_token(self) -> Optional[str]:
+        """Return the in-memory token if it is still valid, without touching disk"""
+        if self._cached_token and time.time() < self._cached_exp - TOKEN_EXPIRY_SKEW:
+            return self._cached_token
+        return None
+
+    def remember_token(self, token: str) -> None:
+        """Keep a validated token and its expiry in memory"""
+        if token != self._cached_token:
+            # A new token may belong to another account; drop results fetched with the old one
+            _list_devices_cache.clear()
+        self._cached_token = token
+        self._cached_exp = jwt_exp(token) or 0
 
     async def load_token_data(self) -> Optional[Dict[str, Any]]:
         """Load token data from JSON file"""
-        if os.path.exists(self.token_file):
-            try:
-                with open(self.token_file, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"Failed to load token data: {e}")
-                return {"error": f"Failed to load token data: {e}"}
-        return None
+        # A single stat both probes for the file and validates the cache
+        try:
+            st = self.token_file.stat()
+        except FileNotFoundError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        if self._token_data_cache and self._token_data_cache[0] == key:
+            return self._token_data_cache[1]
+        try:
+            # Open, read and parse in one worker-thread hop off the event loop
+            data = await asyncio.to_thread(self._read_token_file)
+            self._token_data_cache = (key, data)
+            return data
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Failed to load token data: {e}")
+            return {"error": f"Failed to load token data: {e}"}
     
+    def load_token_data_sync(self) -> Optional[Dict[str, Any]]:
+        """Blocking twin of load_token_data for sync callers, sharing its cache"""
+        try:
+            st = self.token_file.stat()
+        except FileNotFoundError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        if self._token_data_cache and self._token_data_cache[0] == key:
+            return self._token_data_cache[1]
+        try:
+            data = self._read_token_file()
+            self._token_data_cache = (key, data)
+            return data
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Failed to load token data: {e}")
+            return None
+
+    def _read_token_file(self) -> Dict[str, Any]:
+        """Read and parse the token file (blocking)"""
+        with open(self.token_file, 'rb') as f:
+            return _json_loads(f.read())
+
     def save_token_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Save token data to JSON file"""
         try:
-            with open(self.token_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            # Serialize up front, write once, then swap in atomically so
+            # readers never see a half-written file
+            tmp_file = self.token_file.with_suffix(".json.tmp")
+            with open(tmp_file, 'wb') as f:
+                f.write(_json_dumps(data))
+            os.replace(tmp_file, self.token_file)
+            st = self.token_file.stat()
+            self._token_data_cache = ((st.st_mtime_ns, st.st_size), data)
             return {"success": True, "message": "Token data saved successfully"}
         except IOError as e:
             return {"success": False, "error": f"Failed to save token data: {e}"}
 
+    def append_api_call(self, entry: Dict[str, Any]) -> None:
+        """Record an API call in memory and schedule it for the JSONL call log"""
+        self.api_calls.append(entry)
+        self._pending_api_calls.append(_json_dumps(entry) + b"\n")
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_api_calls_later())
+
+    async def _flush_api_calls_later(self) -> None:
+        """Coalesce records arriving within a short window into one file append"""
+        await asyncio.sleep(_API_LOG_FLUSH_DELAY)
+        await self.flush_api_calls()
+
+    async def flush_api_calls(self) -> None:
+        """Append all buffered API call records to the JSONL call log"""
+        while self._pending_api_calls:
+            lines, self._pending_api_calls = self._pending_api_calls, []
+            await asyncio.to_thread(self._write_api_log, b"".join(lines))
+
+    def flush_api_calls_sync(self) -> None:
+        """Append buffered API call records without an event loop (blocking)"""
+        lines, self._pending_api_calls = self._pending_api_calls, []
+        if lines:
+            self._write_api_log(b"".join(lines))
+
+    def _write_api_log(self, data: bytes) -> None:
+        """Append raw JSONL bytes to the call log, rotating it when full (blocking)"""
+        try:
+            try:
+                if self.api_log_file.stat().st_size + len(data) > API_LOG_MAX_BYTES:
+                    os.replace(self.api_log_file, self.api_log_file.with_suffix(".jsonl.1"))
+            except FileNotFoundError:
+                pass
+            with open(self.api_log_file, 'ab') as f:
+                f.write(data)
+        except IOError as e:
+            logger.error(f"Failed to append API call log: {e}")
+
+    def load_api_calls(self, limit: int = API_CALL_HISTORY_SIZE) -> List[Dict[str, Any]]:
+        """Return the most recent API call records"""
+        return list(self.api_calls)[-limit:]
+
+    def _read_api_log_tail(self, limit: int) -> List[Dict[str, Any]]:
+        """Read the last `limit` records from the JSONL call log"""
+        try:
+            with open(self.api_log_file, 'rb') as f:
+                # Read backwards in chunks until the tail holds `limit` complete lines
+                pos = f.seek(0, os.SEEK_END)
+                buf = b""
+                while pos > 0 and buf.count(b"\n") <= limit:
+                    step = min(_API_LOG_TAIL_CHUNK, pos)
+                    pos -= step
+                    f.seek(pos)
+                    buf = f.read(step) + buf
+        except FileNotFoundError:
+            return []
+        except IOError as e:
+            logger.error(f"Failed to read API call log: {e}")
+            return []
+        lines = buf.splitlines()
+        if pos > 0:
+            # The first line may have been cut mid-record
+            lines = lines[1:]
+        calls = []
+        for line in lines[-limit:]:
+            try:
+                calls.append(_json_loads(line))
+            except ValueError:
+                continue
+        return calls
+
     async def run_playwright_token_extraction(
         self,
     ) -> Dict[str, Any]:
         """
-        Run the Playwright token extraction script as a subprocess.
+        Run the Playwright token extraction in the worker process.
 
-        Args:
-            script_path: Path to the Playwright extraction script. If None, uses the default in the same directory.
-            cwd: Working directory for the subprocess. If None, uses the current working directory.
-            timeout: Timeout in seconds for the subprocess.
+        Extractions are serialized so concurrent callers never drive more
+        than one browser login at a time.
 
         Returns:
-            Dict containing stdout, stderr, return code, and success status.
+            Dict containing success status, token, message and timestamp.
+        """
+        async with self._extraction_lock:
+            return await self._extract_and_save()
+
+    async def ensure_token(self) -> Dict[str, Any]:
+        """
+        Single-flight wrapper around run_playwright_token_extraction.
+
+        Concurrent callers await the same in-flight extraction instead of
+        queueing up their own browser login behind the lock.
         """
-        logger = logging.getLogger(__name__)
-        # Auto-fetch script_path and cwd if not provided
+        if self._extraction_task is None or self._extraction_task.done():
+            self._extraction_task = asyncio.create_task(self.run_playwright_token_extraction())
+        # Shield so one cancelled caller doesn't abort the shared extraction
+        return await asyncio.shield(self._extraction_task)
 
+    async def _extract_and_save(self) -> Dict[str, Any]:
+        """Run the extractor and persist its result to the token file."""
         try:
-            result = await self.get_extractor().run()
+            loop = asyncio.get_running_loop()
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self.get_executor(), run_extraction_in_worker),
+                timeout=EXTRACTION_TIMEOUT / 1000
+            )
             # logger.info(f"Playwright token extraction result: {result}")
             if result.get("success"):
                 logger.info("Playwright token extraction completed successfully.")
@@ -92,12 +392,15 @@ class TokenManager:
 
             # logger.info(f"Api test result: {result.get('api_test')}")
 
+            # One timestamp for the response and the saved file
+            now = datetime.now().isoformat()
+
             # Prepare the response in the expected format
             extraction_result = {
                 "success": result.get("success"),
                 "token": result.get("token"),
                 "message": "Token extraction completed successfully.",
-                "retrieved_at": datetime.now().isoformat()
+                "retrieved_at": now
             }
             
             # Save the full result to file (including token_extraction structure)
@@ -107,28 +410,51 @@ class TokenManager:
                         "success": True,
                         "token": result.get("token"),
                         "source": "playwright_extraction",
-                        "extracted_at": datetime.now().isoformat()
+                        "extracted_at": now
                     },
                     "api_test": result.get("api_test"),
-                    "saved_at": datetime.now().isoformat()
+                    "saved_at": now
                 }
-                self.save_token_data(file_data)
+                # Write off the event loop; other tool calls keep running meanwhile
+                await asyncio.to_thread(self.save_token_data, file_data)
+                self.remember_token(result.get("token"))
             
             return extraction_result
         except Exception as e:
+            if isinstance(e, (BrokenProcessPool, asyncio.TimeoutError)):
+                # Worker died (browser crash, OOM) or hung; start a fresh one next time
+                self.discard_executor()
             logger.exception("Unexpected error during Playwright token extraction")
             error_data = {
                 "success": False,
                 "error": str(e),
                 "extracted_at": datetime.now().isoformat()
             }
-            self.save_token_data(error_data)
+            await asyncio.to_thread(self.save_token_data, error_data)
             return error_data
 
 
 # Initialize token manager
 token_manager = TokenManager()
 
+async def _load_valid_token() -> Optional[str]:
+    """
+    Return a valid token from memory or the token file, without extracting.
+    Shared first step of extract_auth_token and _get_valid_token.
+    """
+    token = token_manager.get_cached_token()
+    if token:
+        return token
+
+    token_data = await token_manager.load_token_data() or {}
+    token = _stored_token(token_data)
+
+    # Check if token exists, is not empty, and is not expired
+    if _is_token_valid(token):
+        token_manager.remember_token(token)
+        return token
+    return None
+
 @mcp.tool(
     name="extract_auth_token",
     description="Extracts JWT token from Auth0 authentication using Playwright automation.",
@@ -138,15 +464,8 @@ async def extract_auth_token() -> Dict[str, Any]:
     Extract JWT token from Auth0 authentication using Playwright automation.
     Only runs extraction if token is missing or expired.
     """
-    # 1. Try to load stored token
-    token_data = await token_manager.load_token_data() or {}
-    # logger.debug(f"Loaded token data: {token_data}")
-    extraction_result = token_data.get("token_extraction", {})
-    token = extraction_result.get("token") if isinstance(extraction_result, dict) else None
-
-    # 2. Check if token exists, is not empty, and is not expired
-    logger.debug(f"Token found: {bool(token)}, Token empty: {not token if token else 'N/A'}")
-    if token and token.strip() and not is_jwt_expired(token):
+    token = await _load_valid_token()
+    if token:
         return {
             "success": True,
             "token": token,
@@ -155,76 +474,102 @@ async def extract_auth_token() -> Dict[str, Any]:
         }
 
     logger.info("No valid token found, token is empty, or token is expired. Running Playwright extraction...")
-    result = await token_manager.run_playwright_token_extraction()
+    result = await token_manager.ensure_token()
     logging.info(f"Playwright extraction result: {result}")
     return result
 
-async def _get_valid_token() -> Optional[List]:
+async def _get_valid_token() -> Optional[str]:
     """
-    Retrieve a valid JWT token from storage, or extract a new one if missing/expired.
+    Retrieve a valid JWT token from memory or storage, or extract a new one if missing/expired.
     """
-    token_data = await token_manager.load_token_data() or {}
-    extraction_result = token_data.get("token_extraction", {})
-    token = extraction_result.get("token") if isinstance(extraction_result, dict) else None
-
-    # Check if token exists, is not empty, and is not expired
-    if token and token.strip() and not is_jwt_expired(token):
-        return [token, token_data]
+    token = await _load_valid_token()
+    if token:
+        return token
     
     # Token missing, empty, or expired, extract new token
     logger.info("No valid token found, token is empty, or token is expired. Running Playwright extraction...")
-    extraction = await token_manager.run_playwright_token_extraction()
-    if extraction.get("success") and extraction.get("token"):
-        # Reload token data after extraction
-        token_data = await token_manager.load_token_data() or {}
-        extraction_result = token_data.get("token_extraction", {})
-        token = extraction_result.get("token") if isinstance(extraction_result, dict) else None
-        if token and token.strip() and not is_jwt_expired(token):
-            return [token, token_data]
+    extraction = await token_manager.ensure_token()
+    # Use the extracted token directly rather than re-reading the file just written
+    token = extraction.get("token") if extraction.get("success") else None
+    if _is_token_valid(token):
+        return token
     
     return None
 
-def _prepare_headers(token: str) -> Dict[str, str]:
-    """
-    Prepare headers for the API request using the JWT token.
-    """
-    return {
+# Request headers that don't depend on the token, built once at import
+_BASE_HEADERS = MappingProxyType({
+    key: value for key, value in {
         'accept': 'application/json, text/plain, */*',
         'accept-language': 'en-US,en;q=0.6',
-        'authorization': f'Bearer {token}',
         'content-type': 'application/json',
         'origin': 'https://alt-synappxadminportal.sharpb2bcloud.com',
         'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
         'x-time-zone': '+05:30',
         "ocp-apim-subscription-key": os.getenv("OCP_APIM_SUBSCRIPTION_KEY")
-    }
+    }.items()
+    # httpx rejects None header values; requests used to drop them silently
+    if value is not None
+})
 
-async def _handle_response(response , endpoint: str, method: str) -> Dict[str, Any]:
+@lru_cache(maxsize=4)
+def _prepare_headers(token: str) -> httpx.Headers:
+    """
+    Prepare headers for the API request using the JWT token.
+    Built once per token so httpx reuses the normalized header set;
+    callers must not mutate it.
+    """
+    return httpx.Headers({**_BASE_HEADERS, 'authorization': f'Bearer {token}'})
+
+async def _handle_response(response , endpoint: str, method: str, requested_at: str) -> Dict[str, Any]:
     """
     Handle the API response and log the call.
     """
-    token_data = await token_manager.load_token_data()  or {}
-    try:
-        response_data = response.json()
-    except Exception as e:
+    content_type = response.headers.get("content-type", "")
+    if "json" in content_type:
+        try:
+            response_data = _json_loads(response.content)
+        except ValueError as e:
+            response_data = response.text
+            logger.error(f"Failed to parse response JSON: {e}")
+    else:
+        # Don't attempt a JSON parse of HTML/text/binary bodies
         response_data = response.text
-        logger.error(f"Failed to parse response JSON: {e}")
 
     result = {
         "success": response.status_code in [200, 201, 204],
         "status_code": response.status_code,
         "response_data": response_data,
         "endpoint": endpoint,
-        "method": method.upper(),
-        "requested_at": datetime.now().isoformat()
+        "method": method,
+        "requested_at": requested_at
     }
 
-    api_log = token_data.get("api_calls", [])
-    api_log.append(result)
-    token_data["api_calls"] = api_log[-10:]
-    token_manager.save_token_data(token_data)
+    # Callers get the full body; the call log only records its size
+    log_entry = {k: v for k, v in result.items() if k != "response_data"}
+    log_entry["response_size"] = len(response.content)
+    token_manager.append_api_call(log_entry)
     return result
 
+# HTTP methods accepted by _make_api_call; only POST/PUT send the JSON payload
+_SUPPORTED_METHODS = frozenset({"GET", "POST", "PUT", "DELETE"})
+_BODY_METHODS = frozenset({"POST", "PUT"})
+
+# Characters allowed in the base64 halves of a device ID
+_ID_ALPHABET = frozenset(string.ascii_letters + string.digits + "+/=")
+
+def _valid_device_id(device_id: str) -> bool:
+    """Check the 'mn=<base64>:sn=<base64>' device ID format without a regex."""
+    mn, sep, sn = device_id.partition(":sn=")
+    return bool(
+        sep and sn and len(mn) > 3 and mn.startswith("mn=")
+        and _ID_ALPHABET.issuperset(mn[3:]) and _ID_ALPHABET.issuperset(sn)
+    )
+
+# Input formats validated by the device tools, compiled once at import
+# (\Z rather than $, which would also accept a trailing newline)
+_UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+_DATETIME12_RE = re.compile(r'^\d{12}\Z')
+
 async def _make_api_call(
     endpoint: str,
     method: str = "GET",
@@ -234,12 +579,17 @@ async def _make_api_call(
     Internal helper function to make API calls.
     This is the core logic extracted from make_api_request tool.
     """
+    method = method.upper()
+    if method not in _SUPPORTED_METHODS:
+        return {
+            "success": False,
+            "error": f"Unsupported HTTP method: {method}"
+        }
     token = await _get_valid_token()
-    URL = f"https://alt-rmm-api.sharpb2bcloud.com{endpoint}"
     data = payload or {
         "startIndex": 0,
         "count": 25,
-        "groupId": "6d167a66-9c03-b981-6e37-8770c76676be",
+        "groupId": DEFAULT_GROUP_ID,
         "simpleFilters": [],
         "orderBy": [
             {
@@ -248,42 +598,34 @@ async def _make_api_call(
             }
         ]
     }
-    if not token or not token[0]:
+    if not token:
         return {
             "success": False,
             "error": "No valid token found or failed to extract token."
         }
-    headers = _prepare_headers(token[0])
+    headers = _prepare_headers(token)
+    client = _get_http_client()
+    # One timestamp per call, shared by the success and error results
+    requested_at = datetime.now().isoformat()
     try:
-        if method.upper() == "GET":
-            response = requests.get(URL, headers=headers, timeout=30)
-        elif method.upper() == "POST":
-            response = requests.post(URL, headers=headers, json=data, timeout=30)
-        elif method.upper() == "PUT":
-            response = requests.put(URL, headers=headers, json=data, timeout=30)
-        elif method.upper() == "DELETE":
-            response = requests.delete(URL, headers=headers, timeout=30)
-        else:
-            return {
-                "success": False,
-                "error": f"Unsupported HTTP method: {method}"
-            }
-        return await _handle_response(response, endpoint, method)
+        response = await client.request(
+            method,
+            endpoint,
+            headers=headers,
+            json=data if method in _BODY_METHODS else None
+        )
+        return await _handle_response(response, endpoint, method, requested_at)
     except Exception as e:
-        token_data = await token_manager.load_token_data()  or {}
         error_result = {
             "success": False,
             "error": str(e),
             "endpoint": endpoint,
-            "method": method.upper(),
-            "requested_at": datetime.now().isoformat()
+            "method": method,
+            "requested_at": requested_at
         }
-        api_log = token_data.get("api_calls", [])
-        api_log.append(error_result)
-        token_data["api_calls"] = api_log[-10:]
-        # token_manager.save_token_data(token_data)
+        token_manager.append_api_call(error_result)
         return error_result
-   
+
 @mcp.tool(
     name="make_api_request",
     description="Get devices that require firmware updates. Use this tool when asked about devices needing firmware updates, firmware status, or device update requirements.",
@@ -306,11 +648,17 @@ async def make_api_request(
     Returns:
         any: The API response.
     """
-    return await _make_api_call(endpoint, method, payload)
+    result = await _make_api_call(endpoint, method, payload)
+    if method.upper() != "GET":
+        # Arbitrary writes may change device state; don't serve stale device lists
+        _list_devices_cache.clear()
+    return result
 
+@lru_cache(maxsize=8)
 def _decode_jwt_payload(token: str) -> Optional[Dict[str, Any]]:
     """
     Decode JWT token payload to extract claims using PyJWT library.
+    Results are memoized per token, so callers must not mutate the payload.
     
     Args:
         token (str): JWT token string
@@ -334,9 +682,11 @@ async def _get_group_id_from_token() -> Optional[str]:
     Returns:
         Optional[str]: The sspTenantId from JWT token or None if not found
     """
-    token_data = await token_manager.load_token_data() or {}
-    extraction_result = token_data.get("token_extraction", {})
-    token = extraction_result.get("token") if isinstance(extraction_result, dict) else None
+    # Prefer the in-memory token; only fall back to the file when it's stale
+    token = token_manager.get_cached_token()
+    if not token:
+        token_data = await token_manager.load_token_data() or {}
+        token = _stored_token(token_data)
     
     if not token or not token.strip():
         logger.warning("No token available to extract groupId")
@@ -355,6 +705,34 @@ async def _get_group_id_from_token() -> Optional[str]:
         logger.warning("sspTenantId not found in JWT token payload")
         return None
 
+async def _resolve_group_id(group_id: Optional[str]) -> Tuple[str, str]:
+    """
+    Pick the group ID for a tool call: the caller's, else the JWT's, else the default.
+
+    Returns:
+        Tuple of the group ID and where it came from ("parameter", "jwt_token" or "fallback")
+    """
+    if group_id:
+        return group_id, "parameter"
+    group_id = await _get_group_id_from_token()
+    if group_id:
+        return group_id, "jwt_token"
+    logger.warning("Using fallback default group ID: %s", DEFAULT_GROUP_ID)
+    return DEFAULT_GROUP_ID, "fallback"
+
+def _ms_to_iso(ms: int) -> str:
+    """Format a millisecond Unix timestamp as UTC ISO 8601 without float math."""
+    seconds, millis = divmod(ms, 1000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=millis * 1000).isoformat()
+
+# Seconds a list_devices result is reused for identical polls
+LIST_DEVICES_CACHE_TTL = 30
+# Distinct (group, page) results kept; the oldest is evicted beyond this
+LIST_DEVICES_CACHE_SIZE = 32
+# (group_id, start_index, page_size) -> (fetched_at, result); cleared by calls that
+# may change device state and whenever the token (and so possibly the account) changes
+_list_devices_cache: Dict[Tuple[str, int, int], Tuple[float, Dict[str, Any]]] = {}
+
 @mcp.tool(
     name="list_devices",
     description="Retrieve and display all managed devices with their current firmware status. This tool shows device information including model, serial number, firmware version, and update status. Devices with a 'latestFirmwareVersion' value require firmware updates.",
@@ -362,7 +740,8 @@ async def _get_group_id_from_token() -> Optional[str]:
 async def list_devices(
     group_id: Optional[str] = None,
     page_size: int = 25,
-    start_index: int = 0
+    start_index: int = 0,
+    force_refresh: bool = False
 ) -> Dict[str, Any]:
     """
     List all managed devices with their current firmware status.
@@ -371,6 +750,7 @@ async def list_devices(
         group_id (Optional[str]): Filter by specific group ID. If None, extracts from JWT token.
         page_size (int): Number of devices to return (default: 25, max: 100).
         start_index (int): Starting index for pagination (default: 0).
+        force_refresh (bool): Bypass the short-lived result cache (default: False).
     
     Returns:
         Dict containing device list with formatted information including:
@@ -379,16 +759,8 @@ async def list_devices(
         - Update status and OTA configuration
         - Whether firmware update is needed
     """
-    # Extract group ID from JWT token if not provided
     logger.info(f"Using group ID: {group_id}")
-    if not group_id:
-        group_id = await _get_group_id_from_token()
-        
-    # Use fallback default group ID if extraction fails
-    if not group_id:
-        default_group_id = "6d167a66-9c03-b981-6e37-8770c76676be"
-        group_id = default_group_id
-        logger.warning(f"Using fallback default group ID: {default_group_id}")
+    group_id, group_id_source = await _resolve_group_id(group_id)
     
     target_group_id = group_id
     logger.info(f"Target group ID for device listing: {target_group_id}")
@@ -410,10 +782,17 @@ async def list_devices(
             }
         ]
     }
+    cache_key = (target_group_id, start_index, page_size)
+    cached = _list_devices_cache.get(cache_key)
+    if not force_refresh and cached:
+        age = time.monotonic() - cached[0]
+        if age < LIST_DEVICES_CACHE_TTL:
+            # Hand out a copy so callers can't alter the cached entry
+            return {**copy.deepcopy(cached[1]), "cached": True, "cache_age_seconds": round(age, 1)}
     logger.info(f"Payload for API request: {payload}")
     # Make API request using existing function
     api_result = await _make_api_call(
-        endpoint="/rmm/fss/fwupd/getFirmwareUpdateList",
+        endpoint=_EP_UPDATE_LIST,
         method="POST",
         payload=payload
     )
@@ -422,7 +801,7 @@ async def list_devices(
         return {
             "success": False,
             "error": api_result.get("error", "Failed to retrieve device list"),
-            "endpoint": "/rmm/fss/fwupd/getFirmwareUpdateList"
+            "endpoint": _EP_UPDATE_LIST
         }
     
     response_data = api_result.get("response_data", {})
@@ -465,16 +844,21 @@ async def list_devices(
         "start_index": start_index,
         "page_size": page_size,
         "group_id": target_group_id,
-        "group_id_source": "jwt_token" if group_id == await _get_group_id_from_token() else "parameter_or_fallback"
+        "group_id_source": group_id_source
     }
     
-    return {
+    result = {
         "success": True,
         "summary": summary,
         "devices": formatted_devices,
         "raw_response": response_data,
         "retrieved_at": datetime.now().isoformat()
     }
+    _list_devices_cache.pop(cache_key, None)
+    while len(_list_devices_cache) >= LIST_DEVICES_CACHE_SIZE:
+        del _list_devices_cache[next(iter(_list_devices_cache))]
+    _list_devices_cache[cache_key] = (time.monotonic(), copy.deepcopy(result))
+    return result
 
 @mcp.tool(
     name="configure_ota_mode",
@@ -509,18 +893,15 @@ async def configure_ota_mode(
         }
     
     # Validate device IDs format
-    import re
-    device_id_pattern = r'^mn=[A-Za-z0-9+/=]+:sn=[A-Za-z0-9+/=]+$'
-    invalid_devices = []
-    for device_id in device_ids:
-        if not re.match(device_id_pattern, device_id):
-            invalid_devices.append(device_id)
+    invalid_devices = [d for d in device_ids if not _valid_device_id(d)]
     
     if invalid_devices:
         return {
             "success": False,
             "error": f"Invalid device ID format: {invalid_devices}. Expected format: 'mn=<base64>:sn=<base64>'"
         }
+    # Drop repeated IDs, keeping the caller's order
+    device_ids = list(dict.fromkeys(device_ids))
     
     # Set default hours if not provided
     if start_hour is None:
@@ -544,15 +925,7 @@ async def configure_ota_mode(
                 "error": "start_hour must be less than end_hour when not using 24hr availability (-1)"
             }
     
-    # Extract group ID from JWT token if not provided
-    if not group_id:
-        group_id = await _get_group_id_from_token()
-        
-    # Use fallback default group ID if extraction fails
-    if not group_id:
-        default_group_id = "6d167a66-9c03-b981-6e37-8770c76676be"
-        group_id = default_group_id
-        logger.warning(f"Using fallback default group ID: {default_group_id}")
+    group_id, group_id_source = await _resolve_group_id(group_id)
     
     # Prepare payload for setOTAMode API
     payload = {
@@ -566,16 +939,18 @@ async def configure_ota_mode(
     
     # Make API request to configure OTA mode
     api_result = await _make_api_call(
-        endpoint="/stateful/fss/fwupd/setOTAMode",
+        endpoint=_EP_SET_OTA_MODE,
         method="POST",
         payload=payload
     )
+    # Device state may have changed; don't serve stale device lists
+    _list_devices_cache.clear()
     
     if not api_result.get("success"):
         return {
             "success": False,
             "error": api_result.get("error", "Failed to configure OTA mode"),
-            "endpoint": "/stateful/fss/fwupd/setOTAMode",
+            "endpoint": _EP_SET_OTA_MODE,
             "api_response": api_result
         }
     
@@ -588,7 +963,7 @@ async def configure_ota_mode(
             "success": False,
             "error": "API returned errors",
             "error_details": error_list,
-            "endpoint": "/stateful/fss/fwupd/setOTAMode"
+            "endpoint": _EP_SET_OTA_MODE
         }
     
     # Prepare success response with enhanced window description
@@ -604,7 +979,7 @@ async def configure_ota_mode(
             "description": update_window_description
         },
         "group_id": group_id,
-        "group_id_source": "jwt_token" if group_id == await _get_group_id_from_token() else "parameter_or_fallback"
+        "group_id_source": group_id_source
     }
     
     return {
@@ -635,11 +1010,7 @@ async def list_staged_firmware(
     Returns:
         Dict containing a list of firmware files with metadata.
     """
-    # Extract group ID from JWT token if not provided
-    if not group_id:
-        group_id = await _get_group_id_from_token()
-    if not group_id:
-        group_id = "6d167a66-9c03-b981-6e37-8770c76676be"  # fallback default
+    group_id, _ = await _resolve_group_id(group_id)
 
     payload = {
         "startIndex": start_index,
@@ -648,7 +1019,7 @@ async def list_staged_firmware(
     }
 
     api_result = await _make_api_call(
-        endpoint="/rmm/fss/fwupd/getFirmwareDataList",
+        endpoint=_EP_FIRMWARE_DATA_LIST,
         method="POST",
         payload=payload
     )
@@ -657,7 +1028,7 @@ async def list_staged_firmware(
         return {
             "success": False,
             "error": api_result.get("error", "Failed to retrieve staged firmware list"),
-            "endpoint": "/rmm/fss/fwupd/getFirmwareDataList"
+            "endpoint": _EP_FIRMWARE_DATA_LIST
         }
 
     response_data = api_result.get("response_data", {})
@@ -699,7 +1070,8 @@ async def schedule_firmware_update(
     transfer_datetime: int,
     execute_datetime: str,
     timezone: str = "UTC+05:30",
-    group_id: Optional[str] = None
+    group_id: Optional[str] = None,
+    verbose: bool = False
 ) -> Dict[str, Any]:
     """
     Schedule firmware update for specified devices.
@@ -711,6 +1083,7 @@ async def schedule_firmware_update(
         execute_datetime (str): When to execute update (format: "YYYYMMDDHHMM")
         timezone (str): Timezone for the transfer (default: "UTC+05:30")
         group_id (Optional[str]): Group ID. If None, extracts from JWT token
+        verbose (bool): Include the raw upstream response (default: False)
     
     Note:
         - Before directly scheduling ask the user if they want to schedule a firmware update.
@@ -722,30 +1095,25 @@ async def schedule_firmware_update(
         Dict containing scheduling result and validation details
     """
     # Validate device IDs format
-    import re
-    device_id_pattern = r'^mn=[A-Za-z0-9+/=]+:sn=[A-Za-z0-9+/=]+$'
-    invalid_devices = []
-    for device_id in device_ids:
-        if not re.match(device_id_pattern, device_id):
-            invalid_devices.append(device_id)
+    invalid_devices = [d for d in device_ids if not _valid_device_id(d)]
     
     if invalid_devices:
         return {
             "success": False,
             "error": f"Invalid device ID format: {invalid_devices}. Expected format: 'mn=<base64>:sn=<base64>'"
         }
+    # Drop repeated IDs, keeping the caller's order
+    device_ids = list(dict.fromkeys(device_ids))
     
     # Validate firmware file ID (UUID format)
-    uuid_pattern = r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
-    if not re.match(uuid_pattern, firmware_file_id):
+    if not _UUID_RE.match(firmware_file_id):
         return {
             "success": False,
             "error": f"Invalid firmware file ID format: {firmware_file_id}. Expected UUID format."
         }
     
     # Validate execute_datetime format (YYYYMMDDHHMM)
-    datetime_pattern = r'^\d{12}$'
-    if not re.match(datetime_pattern, execute_datetime):
+    if not _DATETIME12_RE.match(execute_datetime):
         return {
             "success": False,
             "error": f"Invalid execute_datetime format: {execute_datetime}. Expected format: YYYYMMDDHHMM"
@@ -759,15 +1127,7 @@ async def schedule_firmware_update(
             "error": f"transfer_datetime must be in the future. Current: {current_timestamp}, Provided: {transfer_datetime}"
         }
     
-    # Extract group ID from JWT token if not provided
-    if not group_id:
-        group_id = await _get_group_id_from_token()
-        
-    # Use fallback default group ID if extraction fails
-    if not group_id:
-        default_group_id = "6d167a66-9c03-b981-6e37-8770c76676be"
-        group_id = default_group_id
-        logger.warning(f"Using fallback default group ID: {default_group_id}")
+    group_id, group_id_source = await _resolve_group_id(group_id)
     
     # Prepare payload for setUpdateReservation API
     payload = {
@@ -782,16 +1142,18 @@ async def schedule_firmware_update(
     
     # Make API request to schedule firmware update
     api_result = await _make_api_call(
-        endpoint="/rmm/fss/fwupd/setUpdateReservation",
+        endpoint=_EP_SET_RESERVATION,
         method="POST",
         payload=payload
     )
+    # Device state may have changed; don't serve stale device lists
+    _list_devices_cache.clear()
     
     if not api_result.get("success"):
         return {
             "success": False,
             "error": api_result.get("error", "Failed to schedule firmware update"),
-            "endpoint": "/rmm/fss/fwupd/setUpdateReservation",
+            "endpoint": _EP_SET_RESERVATION,
             "api_response": api_result
         }
     
@@ -804,19 +1166,12 @@ async def schedule_firmware_update(
             "success": False,
             "error": "API returned errors",
             "error_details": error_list,
-            "endpoint": "/rmm/fss/fwupd/setUpdateReservation"
+            "endpoint": _EP_SET_RESERVATION
         }
     
-    # Format transfer datetime for display
-    transfer_dt = datetime.fromtimestamp(transfer_datetime / 1000)
-    
     # Format execute datetime for display
-    execute_year = execute_datetime[:4]
-    execute_month = execute_datetime[4:6]
-    execute_day = execute_datetime[6:8]
-    execute_hour = execute_datetime[8:10]
-    execute_minute = execute_datetime[10:12]
-    execute_formatted = f"{execute_year}-{execute_month}-{execute_day} {execute_hour}:{execute_minute}"
+    d = execute_datetime
+    execute_formatted = f"{d[:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}"
     
     schedule_summary = {
         "scheduled_devices": len(device_ids),
@@ -824,7 +1179,7 @@ async def schedule_firmware_update(
         "firmware_file_id": firmware_file_id,
         "transfer_schedule": {
             "timestamp": transfer_datetime,
-            "datetime": transfer_dt.isoformat(),
+            "datetime": _ms_to_iso(transfer_datetime),
             "timezone": timezone
         },
         "execute_schedule": {
@@ -832,16 +1187,19 @@ async def schedule_firmware_update(
             "formatted": execute_formatted
         },
         "group_id": group_id,
-        "group_id_source": "jwt_token" if group_id == await _get_group_id_from_token() else "parameter_or_fallback"
+        "group_id_source": group_id_source
     }
     
-    return {
+    result = {
         "success": True,
         "message": f"Successfully scheduled firmware update for {len(device_ids)} device(s)",
         "schedule": schedule_summary,
-        "raw_response": response_data,
         "scheduled_at": datetime.now().isoformat()
     }
+    # The upstream echo can be large; only ship it when asked for
+    if verbose:
+        result["raw_response"] = response_data
+    return result
 
 @mcp.tool(
     name="cancel_scheduled_update",
@@ -849,7 +1207,8 @@ async def schedule_firmware_update(
 )
 async def cancel_scheduled_update(
     device_ids: List[str],
-    group_id: Optional[str] = None
+    group_id: Optional[str] = None,
+    verbose: bool = False
 ) -> Dict[str, Any]:
     """
     Cancel scheduled firmware updates for specified devices.
@@ -857,33 +1216,23 @@ async def cancel_scheduled_update(
     Args:
         device_ids (List[str]): Array of target device IDs to cancel updates for
         group_id (Optional[str]): Group ID. If None, extracts from JWT token
+        verbose (bool): Include the raw upstream response (default: False)
     
     Returns:
         Dict containing cancellation result and validation details
     """
     # Validate device IDs format
-    import re
-    device_id_pattern = r'^mn=[A-Za-z0-9+/=]+:sn=[A-Za-z0-9+/=]+$'
-    invalid_devices = []
-    for device_id in device_ids:
-        if not re.match(device_id_pattern, device_id):
-            invalid_devices.append(device_id)
+    invalid_devices = [d for d in device_ids if not _valid_device_id(d)]
     
     if invalid_devices:
         return {
             "success": False,
             "error": f"Invalid device ID format: {invalid_devices}. Expected format: 'mn=<base64>:sn=<base64>'"
         }
+    # Drop repeated IDs, keeping the caller's order
+    device_ids = list(dict.fromkeys(device_ids))
     
-    # Extract group ID from JWT token if not provided
-    if not group_id:
-        group_id = await _get_group_id_from_token()
-        
-    # Use fallback default group ID if extraction fails
-    if not group_id:
-        default_group_id = "6d167a66-9c03-b981-6e37-8770c76676be"
-        group_id = default_group_id
-        logger.warning(f"Using fallback default group ID: {default_group_id}")
+    group_id, group_id_source = await _resolve_group_id(group_id)
     
     # Prepare payload for removeUpdateReservation API
     payload = {
@@ -894,16 +1243,18 @@ async def cancel_scheduled_update(
     
     # Make API request to cancel scheduled updates
     api_result = await _make_api_call(
-        endpoint="/rmm/fss/fwupd/removeUpdateReservation",
+        endpoint=_EP_REMOVE_RESERVATION,
         method="POST",
         payload=payload
     )
+    # Device state may have changed; don't serve stale device lists
+    _list_devices_cache.clear()
     
     if not api_result.get("success"):
         return {
             "success": False,
             "error": api_result.get("error", "Failed to cancel scheduled updates"),
-            "endpoint": "/rmm/fss/fwupd/removeUpdateReservation",
+            "endpoint": _EP_REMOVE_RESERVATION,
             "api_response": api_result
         }
     
@@ -916,23 +1267,26 @@ async def cancel_scheduled_update(
             "success": False,
             "error": "API returned errors",
             "error_details": error_list,
-            "endpoint": "/rmm/fss/fwupd/removeUpdateReservation"
+            "endpoint": _EP_REMOVE_RESERVATION
         }
     
     cancellation_summary = {
         "cancelled_devices": len(device_ids),
         "device_ids": device_ids,
         "group_id": group_id,
-        "group_id_source": "jwt_token" if group_id == await _get_group_id_from_token() else "parameter_or_fallback"
+        "group_id_source": group_id_source
     }
     
-    return {
+    result = {
         "success": True,
         "message": f"Successfully cancelled scheduled updates for {len(device_ids)} device(s)",
         "cancellation": cancellation_summary,
-        "raw_response": response_data,
         "cancelled_at": datetime.now().isoformat()
     }
+    # The upstream echo can be large; only ship it when asked for
+    if verbose:
+        result["raw_response"] = response_data
+    return result
 
 # Add a resource for the token file
 @mcp.resource(uri="file://auth_token.json")
@@ -943,15 +1297,12 @@ def get_token_file() -> str:
     Returns:
         String content of the auth_token.json file
     """
-    try:
-        if os.path.exists(token_manager.token_file):
-            with open(token_manager.token_file, 'r') as f:
-                token_data = json.load(f)
-            return json.dumps(token_data, indent=2)
-    except Exception as e:
-        logger.error(f"Error reading token file: {e}")
-    
-    return json.dumps({"message": "No token data available"}, indent=2)
+    # Served from the parse cache shared with the tools; copy before adding
+    # api_calls so the cached dict isn't mutated
+    token_data = token_manager.load_token_data_sync()
+    if token_data is not None:
+        return _json_dumps_pretty({**token_data, "api_calls": token_manager.load_api_calls()})
+    return _json_dumps_pretty({"message": "No token data available"})
 
 
 
@@ -3,14 +3,18 @@ Optimized Playwright script to extract JWT token from Auth0 login and store in J
 """
 
 import asyncio
+import base64
 import json
 import os
 import re
+import time
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 from playwright.async_api import async_playwright, Page, BrowserContext
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging
 
@@ -25,29 +29,31 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-def is_jwt_expired(token: str) -> bool:
-    """Check if a JWT token is expired."""
-    import base64
-    import time
+@lru_cache(maxsize=32)
+def jwt_exp(token: str) -> Optional[int]:
+    """Decode the numeric `exp` claim of a JWT; cached since it never changes for a token."""
     try:
-        payload = token.split('.')[1]
+        payload = token.split('.', 2)[1]
         # Pad base64 string
-        padding = '=' * (-len(payload) % 4)
-        payload += padding
-        decoded = base64.urlsafe_b64decode(payload)
-        import json
-        payload_json = json.loads(decoded)
-        exp = payload_json.get('exp')
-        if exp is None:
-            return True
-        now = int(time.time())
-        return now >= exp
-    except Exception as e:
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except Exception:
+        return None
+    return exp if isinstance(exp, (int, float)) else None
+
+def is_jwt_expired(token: str) -> bool:
+    """Check if a JWT token is expired."""
+    # Anything that isn't a token string (None, a Path, ...) counts as expired
+    if not isinstance(token, str):
         return True
+    # Only exp is cached; the comparison with the clock happens on every call
+    exp = jwt_exp(token)
+    if exp is None:
+        return True
+    return int(time.time()) >= exp
 
 def get_stored_token(token_file: str) -> str:
     """Read the JWT token from the token file if it exists and is valid."""
-    import os
     if not os.path.exists(token_file):
         return None
     try:
@@ -60,6 +66,24 @@ def get_stored_token(token_file: str) -> str:
         return None
     return None
 
+# Token patterns, compiled once. The "-" is escaped so it isn't read as a
+# 9-to-_ range that would also match ':', '<', '@', '[' and friends
+_JWT_RE = re.compile(r'eyJ[A-Za-z0-9_\-=]+\.eyJ[A-Za-z0-9_\-=]+\.[A-Za-z0-9_\-.+/=]*')
+_CODE_RE = re.compile(r'code=([^&]+)')
+_ACCESS_TOKEN_RE = re.compile(r'access_token=([^&]+)')
+
+# Resources the login flow never needs; stylesheets stay so visibility checks still work
+_BLOCKED_RESOURCE_TYPES = frozenset({'image', 'font', 'media'})
+_BLOCKED_HOSTS = ('doubleclick.net', 'googletagmanager.com', 'google-analytics.com')
+
+async def _block_unneeded_resources(route) -> None:
+    """Abort images, fonts, media and analytics beacons so pages go idle sooner."""
+    request = route.request
+    if request.resource_type in _BLOCKED_RESOURCE_TYPES or any(host in request.url for host in _BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
 class AuthTokenExtractor:
     """Handles Auth0 authentication flow and JWT token extraction."""
     
@@ -72,18 +96,20 @@ class AuthTokenExtractor:
         self.api_url = f"{self.api_base_url}/{self.tenant_endpoint}"
         self.token_file = Path(os.getenv('TOKEN_FILE', 'auth_token.json'))
         
-        # Debug: Print loaded credentials (removed emoji)
         logger.debug("Loaded username from .env: '%s'", self.username)
-        logger.debug("Loaded password from .env: '%s'", self.password)
+        logger.debug("Password loaded: %s", "***" if self.password else "MISSING")
         
         # Timeouts
-        print("DASHBOARD_TIMEOUT:", os.getenv('DASHBOARD_TIMEOUT', 40000))
         self.dashboard_timeout = int(os.getenv('DASHBOARD_TIMEOUT', 40000))
         self.element_timeout = int(os.getenv('ELEMENT_TIMEOUT', 40000))
         self.api_trigger_timeout = int(os.getenv('API_TRIGGER_TIMEOUT', 40000))
         
         # Browser config
-        self.headless = os.getenv('HEADLESS').lower() == 'true'
+        self.headless = os.getenv('HEADLESS', 'false').lower() == 'true'
+        # chromium usually cold-starts faster; firefox stays the default
+        self.browser_name = os.getenv('PLAYWRIGHT_BROWSER', 'firefox').lower()
+        if self.browser_name not in ('chromium', 'firefox', 'webkit'):
+            raise ValueError(f"Unsupported PLAYWRIGHT_BROWSER: {self.browser_name}")
         self.slow_mo = int(os.getenv('SLOW_MO', 1500))
         self.viewport_width = int(os.getenv('VIEWPORT_WIDTH', 1920))
         self.viewport_height = int(os.getenv('VIEWPORT_HEIGHT', 1080))
@@ -91,8 +117,29 @@ class AuthTokenExtractor:
         # Selectors
         self._init_selectors()
         
-        # Token storage
+        # Token storage; the event lets waits wake as soon as a token is intercepted
         self.intercepted_token: Optional[str] = None
+        self._token_event = asyncio.Event()
+        
+        # Keep-alive session for API checks; only the bearer token varies per call
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self._session.headers.update({
+            'accept': 'application/json, text/plain, */*',
+            'accept-language': 'en-US,en;q=0.6',
+            'content-type': 'application/json',
+            'origin': 'https://dev7-smartoffice.sharpb2bcloud.com',
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
+            'x-app-version': '4.16.0-SNAPSHOT-20250717-110003',
+            'x-time-zone': '+05:30'
+        })
+        
+        # In-flight run() shared by concurrent callers
+        self._run_task: Optional[asyncio.Task] = None
+        
+        # Browser kept alive across extractions; launched by start()
+        self._playwright = None
+        self._browser = None
 
     def _init_selectors(self):
         """Initialize all CSS selectors used in the authentication flow."""
@@ -148,26 +195,41 @@ class AuthTokenExtractor:
     def _setup_network_interceptors(self, page: Page) -> None:
         """Set up network request/response interceptors for token capture."""
         def handle_request(request):
-            if self.api_url in request.url:
-                auth_header = request.headers.get('authorization', '')
-                if auth_header.startswith('Bearer '):
-                    self.intercepted_token = auth_header.replace('Bearer ', '')
-                    logger.info(f"JWT TOKEN FOUND in request to {self.api_url}")
-                    logger.debug(f"Authorization header: Bearer {self.intercepted_token[:50]}...")
+            # Cheap URL test first; headers are only read for the API endpoint
+            if self.api_url not in request.url:
+                return
+            auth_header = request.headers.get('authorization', '')
+            if auth_header.startswith('Bearer '):
+                self.intercepted_token = auth_header[len('Bearer '):]
+                self._token_event.set()
+                logger.info(f"JWT TOKEN FOUND in request to {self.api_url}")
+                logger.debug(f"Authorization header: Bearer {self.intercepted_token[:50]}...")
 
         def handle_response(response):
+            # The response fallback is only needed until some token is captured
+            if self.intercepted_token:
+                page.remove_listener('response', handle_response)
+                return
             if self.api_url in response.url:
                 logger.info(f"Response from {self.api_url}")
             
             # Capture Bearer tokens from any response
             auth_header = response.headers.get('authorization', '')
-            if auth_header.startswith('Bearer ') and not self.intercepted_token:
-                self.intercepted_token = auth_header.replace('Bearer ', '')
+            if auth_header.startswith('Bearer '):
+                self.intercepted_token = auth_header[len('Bearer '):]
+                self._token_event.set()
                 logger.info(f"Token intercepted from response ({response.url}): {self.intercepted_token[:50]}...")
             
         page.on('request', handle_request)
         page.on('response', handle_response)
 
+    async def _wait_for_network_idle(self, page: Page, timeout: int = 5000) -> None:
+        """Wait for the page to settle after a navigation; a busy page is not an error."""
+        try:
+            await page.wait_for_load_state('networkidle', timeout=timeout)
+        except Exception as e:
+            logger.debug(f"Network did not go idle within {timeout} ms: {e}")
+
     async def _fill_element(self, page: Page, selector: str, value: str, field_name: str) -> bool:
         """Fill a form element with value."""
 
@@ -200,32 +262,57 @@ class AuthTokenExtractor:
             logger.error(f"Failed to click {description or selector}: {e}")
             return False
 
+    async def _first_visible(self, page: Page, selectors: List[str], timeout: int = 5000) -> Optional[str]:
+        """Race visibility waits for several selectors and return the first one to appear."""
+        tasks = {
+            asyncio.create_task(page.wait_for_selector(selector, state='visible', timeout=timeout)): selector
+            for selector in selectors
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Check every finished task so failed waits don't log "exception never retrieved"
+                succeeded = {task for task in done if task.exception() is None}
+                if succeeded:
+                    # Several may finish in the same tick; keep the caller's selector priority
+                    return next(selector for task, selector in tasks.items() if task in succeeded)
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
     async def _try_selectors(self, page: Page, selectors: List[str], action: str, **kwargs) -> bool:
         """Try multiple selectors for the same action."""
-        for selector in selectors:
-            try:
-                if action == "click":
+        if action == "click":
+            for selector in selectors:
+                try:
                     element = await page.query_selector(selector)
                     if element and await element.is_visible():
                         await element.click()
                         logger.info(f"Successfully clicked using selector: {selector}")
                         return True
-                elif action == "fill":
-                    await page.wait_for_selector(selector, state='visible', timeout=5000)
-                    await page.fill(selector, kwargs['value'])
-                    filled_value = await page.input_value(selector)
-                    if filled_value == kwargs['value']:
-                        logger.info(f"Successfully filled {kwargs.get('field_name', 'field')} using: {selector}")
-                        return True
+                except Exception as e:
+                    logger.warning(f"Failed with selector {selector}: {e}")
+        elif action == "fill":
+            # Wait for all candidates at once rather than 5 s per missing selector
+            selector = await self._first_visible(page, selectors)
+            if selector is None:
+                logger.warning(f"None of the selectors became visible: {selectors}")
+                return False
+            try:
+                await page.fill(selector, kwargs['value'])
+                filled_value = await page.input_value(selector)
+                if filled_value == kwargs['value']:
+                    logger.info(f"Successfully filled {kwargs.get('field_name', 'field')} using: {selector}")
+                    return True
             except Exception as e:
                 logger.warning(f"Failed with selector {selector}: {e}")
-                continue
         return False
 
     async def _handle_auth0_login(self, page: Page) -> bool:
         """Handle Auth0 login form."""
         logger.info("Step 2: Handling Auth0 login form...")
-        await page.wait_for_timeout(3000)
         logger.info("self.username: %s", self.username)
         # Fill email field
         if not await self._fill_element(page, self.selectors['auth0_email'], self.username, "Email"):
@@ -235,18 +322,16 @@ class AuthTokenExtractor:
                 return False
         
         # Click continue button
-        await page.wait_for_timeout(1000)
         if not await self._try_selectors(page, self.selectors['auth0_continue'], "click"):
             logger.warning("No continue button found, proceeding...")
         else:
-            await page.wait_for_timeout(3000)
+            await self._wait_for_network_idle(page)
         
         return True
 
     async def _handle_sharp_start_selection(self, page: Page) -> bool:
         """Handle Sharp-Start provider selection."""
         logger.info("Step 3: Looking for Sharp-Start button...")
-        await page.wait_for_timeout(2000)
         
         # Try exact Sharp-Start selector
         try:
@@ -261,26 +346,32 @@ class AuthTokenExtractor:
         except Exception as e:
             logger.warning(f"Exact Sharp-Start selector failed: {e}")
         
-        # Try fallback selectors
-        for selector in self.selectors['sharp_start_fallback']:
-            try:
-                elements = await page.query_selector_all(selector)
-                for element in elements:
+        # Try fallback selectors: query them all at once, then check matches in
+        # list priority order (a comma-joined query would return DOM order instead)
+        fallbacks = self.selectors['sharp_start_fallback']
+        results = await asyncio.gather(
+            *(page.query_selector_all(selector) for selector in fallbacks), return_exceptions=True
+        )
+        for elements in results:
+            if isinstance(elements, Exception):
+                continue
+            for element in elements:
+                try:
                     text_content = await element.text_content()
-                    is_visible = await element.is_visible()
-                    if is_visible and text_content and ('sharp' in text_content.lower() or 'start' in text_content.lower()):
+                    if not text_content or ('sharp' not in text_content.lower() and 'start' not in text_content.lower()):
+                        continue
+                    if await element.is_visible():
                         await element.click()
                         logger.info(f"Clicked provider button: {text_content}")
                         return True
-            except Exception:
-                continue
+                except Exception:
+                    continue
         
         return False
 
     async def _handle_sharp_login(self, page: Page) -> bool:
         """Handle Sharp login form."""
         logger.info("Step 4: Handling Sharp login form...")
-        await page.wait_for_timeout(5000)
         
         # Wait for form to appear
         try:
@@ -305,15 +396,29 @@ class AuthTokenExtractor:
     async def _wait_for_dashboard(self, page: Page) -> bool:
         """Wait for successful login and dashboard redirect."""
         logger.info(f"Step 5: Waiting for dashboard redirect ({self.dashboard_timeout/1000} second timeout)...")
+        # Either landing on an app route or the app calling the API means login went through
+        # Build both waiters before scheduling either, so a failure can't orphan a task
+        url_wait = page.wait_for_url(
+            lambda url: any(part in url for part in ('/callback', '/dashboard', '/manage')),
+            timeout=self.dashboard_timeout
+        )
+        request_wait = page.wait_for_event(
+            "request", predicate=lambda request: self.api_url in request.url, timeout=self.dashboard_timeout
+        )
+        pending = {asyncio.create_task(url_wait), asyncio.create_task(request_wait)}
+        succeeded = False
         try:
-            await page.wait_for_url(['**/callback*', '**/dashboard*', '**/manage*', '*smartoffice*'], 
-                                timeout=self.dashboard_timeout)
-        except:
-            await page.wait_for_timeout(50000)
-            current_url = page.url
-            logger.info(f"Current URL after timeout: {current_url}")
-            if 'auth0.com' in current_url:
-                return False
+            while pending and not succeeded:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = any(task.exception() is None for task in done)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        
+        if not succeeded:
+            logger.info(f"Current URL after timeout: {page.url}")
+            return False
         
         logger.info(f"Login successful! Current URL: {page.url}")
         return True
@@ -323,30 +428,23 @@ class AuthTokenExtractor:
         try:
             token = await page.evaluate("""
                 () => {
-                    const storages = [localStorage, sessionStorage];
-                    for (let storage of storages) {
-                        for (let i = 0; i < storage.length; i++) {
-                            const key = storage.key(i);
+                    for (const storage of [localStorage, sessionStorage]) {
+                        for (const key of Object.keys(storage)) {
                             const value = storage.getItem(key);
+                            if (!value) continue;
+                            if (value.startsWith('eyJ')) return value;
                             
-                            if (value && value.startsWith('eyJ')) {
-                                return value;
+                            // Only values that look like JSON objects are worth parsing
+                            if (value.charCodeAt(0) === 123) {
+                                try {
+                                    const parsed = JSON.parse(value);
+                                    if (parsed.access_token?.startsWith?.('eyJ')) return parsed.access_token;
+                                    if (parsed.token?.startsWith?.('eyJ')) return parsed.token;
+                                } catch (e) {}
                             }
                             
-                            try {
-                                const parsed = JSON.parse(value);
-                                if (parsed.access_token && parsed.access_token.startsWith('eyJ')) {
-                                    return parsed.access_token;
-                                }
-                                if (parsed.token && parsed.token.startsWith('eyJ')) {
-                                    return parsed.token;
-                                }
-                            } catch (e) {}
-                            
-                            if (value && value.includes('eyJ')) {
-                                const match = value.match(/eyJ[A-Za-z0-9-_=]+\\.eyJ[A-Za-z0-9-_=]+\\.[A-Za-z0-9-_.+/=]*/);
-                                if (match) return match[0];
-                            }
+                            const match = value.match(/eyJ[\\w=-]+\\.eyJ[\\w=-]+\\.[\\w.+\\/=-]*/);
+                            if (match) return match[0];
                         }
                     }
                     return null;
@@ -364,21 +462,34 @@ class AuthTokenExtractor:
         try:
             cookies = await context.cookies()
             for cookie in cookies:
-                if cookie['value'].startswith('eyJ'):
-                    logger.info(f"JWT token found in cookie {cookie['name']}: {cookie['value'][:50]}...")
-                    return cookie['value']
-                elif 'eyJ' in cookie['value']:
-                    jwt_match = re.search(r'eyJ[A-Za-z0-9-_=]+\.eyJ[A-Za-z0-9-_=]+\.[A-Za-z0-9-_.+/=]*', cookie['value'])
-                    if jwt_match:
-                        logger.info(f"JWT token extracted from cookie {cookie['name']}: {jwt_match.group(0)[:50]}...")
-                        return jwt_match.group(0)
+                value = cookie['value']
+                # Substring test first; the regex only runs on cookies that can hold a JWT
+                if 'eyJ' not in value:
+                    continue
+                if value.startswith('eyJ'):
+                    logger.info(f"JWT token found in cookie {cookie['name']}: {value[:50]}...")
+                    return value
+                jwt_match = _JWT_RE.search(value)
+                if jwt_match:
+                    logger.info(f"JWT token extracted from cookie {cookie['name']}: {jwt_match.group(0)[:50]}...")
+                    return jwt_match.group(0)
         except Exception as e:
             logger.error(f"Error accessing cookies: {e}")
         return None
 
+    async def _wait_for_token(self, timeout: int) -> bool:
+        """Wait up to timeout ms for a token to be intercepted, returning as soon as one is."""
+        try:
+            await asyncio.wait_for(self._token_event.wait(), timeout / 1000)
+        except asyncio.TimeoutError:
+            pass
+        return bool(self.intercepted_token)
+
     async def _trigger_api_calls(self, page: Page) -> bool:
         """Try to trigger API calls that contain JWT tokens."""
         logger.info("Trying to trigger API calls...")
+        if self.intercepted_token:
+            return True
         
         # Try clicking various elements
         for selector in self.selectors['api_triggers']:
@@ -388,8 +499,7 @@ class AuthTokenExtractor:
                     if await element.is_visible():
                         logger.info(f"Clicking element to trigger API calls: {selector}")
                         await element.click()
-                        await page.wait_for_timeout(3000)
-                        if self.intercepted_token:
+                        if await self._wait_for_token(3000):
                             return True
                         break
             except Exception as e:
@@ -407,8 +517,7 @@ class AuthTokenExtractor:
             try:
                 logger.info(f"Navigating to {nav_url}...")
                 await page.goto(nav_url, wait_until='networkidle', timeout=40000)
-                await page.wait_for_timeout(5000)
-                if self.intercepted_token:
+                if await self._wait_for_token(5000):
                     return True
             except Exception as e:
                 logger.warning(f"Error navigating to {nav_url}: {e}")
@@ -417,122 +526,146 @@ class AuthTokenExtractor:
         try:
             logger.info("Reloading page to trigger initialization API calls...")
             await page.reload(wait_until='networkidle')
-            await page.wait_for_timeout(self.api_trigger_timeout)
-            if self.intercepted_token:
+            if await self._wait_for_token(self.api_trigger_timeout):
                 return True
         except Exception as e:
             logger.warning(f"Error during page reload: {e}")
         
         return False
 
-    async def login_and_extract_token(self) -> Dict:
-        """Main login and token extraction method."""
-        async with async_playwright() as p:
-            browser = await p.firefox.launch(
+    async def start(self):
+        """Launch the browser once and reuse it until close() or a crash."""
+        if self._browser is None or not self._browser.is_connected():
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            browser_type = getattr(self._playwright, self.browser_name)
+            self._browser = await browser_type.launch(
                 headless=self.headless,
                 slow_mo=self.slow_mo,
                 args=['--disable-web-security']
             )
-            
+        return self._browser
+
+    async def close(self) -> None:
+        """Shut down the pooled browser, the Playwright driver and the HTTP session."""
+        self._session.close()
+        if self._browser is not None:
             try:
-                context = await browser.new_context(
-                    viewport={'width': self.viewport_width, 'height': self.viewport_height},
-                    user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'
-                )
-                
-                page = await context.new_page()
-                self._setup_network_interceptors(page)
-                
-                logger.info("Step 1: Navigating to Auth0 login page...")
-                await page.goto(self.login_url, wait_until='networkidle')
-                
-                # Authentication flow
-                if not await self._handle_auth0_login(page):
-                    raise Exception("Auth0 login failed")
-                
-                if not await self._handle_sharp_start_selection(page):
-                    raise Exception("Sharp-Start selection failed")
-                
-                if not await self._handle_sharp_login(page):
-                    raise Exception("Sharp login failed")
-                
-                if not await self._wait_for_dashboard(page):
-                    raise Exception("Dashboard redirect failed")
-                
-                # Token extraction
-                logger.info("Step 6: Extracting authentication token...")
-                await page.wait_for_timeout(5000)
-                
-                current_url = page.url
-                logger.info(f"Current URL: {current_url}")
-                
-                # Check for authorization code
-                code_match = re.search(r'code=([^&]+)', current_url)
-                if code_match:
-                    auth_code = code_match.group(1)
-                    logger.info(f"Authorization code found: {auth_code[:20]}...")
-                
-                # Priority 1: Already intercepted token
-                if self.intercepted_token:
-                    logger.info(f"Token already intercepted: {self.intercepted_token[:50]}...")
-                    return self._create_success_response(self.intercepted_token, 'api_request_interception', page)
-                
-                # Priority 2: Trigger API calls
-                if await self._trigger_api_calls(page):
-                    logger.info(f"Token intercepted after triggering API calls!")
-                    return self._create_success_response(self.intercepted_token, 'api_call_triggered', page)
-                
-                # Priority 3: URL fragment
-                if '#' in current_url:
-                    fragment = current_url.split('#')[1]
-                    token_match = re.search(r'access_token=([^&]+)', fragment)
-                    if token_match:
-                        token = token_match.group(1)
-                        logger.info(f"Access token found in URL fragment: {token[:50]}...")
-                        return self._create_success_response(token, 'url_fragment', page)
-                
-                # Priority 4: Browser storage
-                token = await self._extract_token_from_storage(page)
-                if token:
-                    return self._create_success_response(token, 'browser_storage', page)
-                
-                # Priority 5: Cookies
-                token = await self._extract_token_from_cookies(context)
-                if token:
-                    return self._create_success_response(token, 'cookies', page)
-                
-                # Fallback: Use intercepted token if available
-                if self.intercepted_token:
-                    return self._create_success_response(self.intercepted_token, 'intercepted_fallback', page)
-                
-                # No token found but have auth code
-                if code_match:
-                    return {
-                        'success': False,
-                        'token': None,
-                        'authorization_code': auth_code,
-                        'message': 'Login successful but JWT token not found. Authorization code available.',
-                        'extracted_at': datetime.now().isoformat(),
-                        'url': page.url,
-                        'final_page_title': await page.title()
-                    }
-                
-                return self._create_failure_response('No token found', page)
-                
+                await self._browser.close()
             except Exception as e:
-                logger.error(f"Error during login process: {e}")
-                try:
-                    await page.screenshot(path='debug_error.png')
-                except:
-                    pass
+                logger.warning(f"Error closing browser: {e}")
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def login_and_extract_token(self) -> Dict:
+        """Main login and token extraction method."""
+        browser = await self.start()
+        # Fresh context per run so every login starts without cookies or storage
+        context = await browser.new_context(
+            viewport={'width': self.viewport_width, 'height': self.viewport_height},
+            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'
+        )
+        await context.route("**/*", _block_unneeded_resources)
+        self.intercepted_token = None
+        self._token_event.clear()
+        
+        try:
+            page = await context.new_page()
+            self._setup_network_interceptors(page)
+            
+            logger.info("Step 1: Navigating to Auth0 login page...")
+            await page.goto(self.login_url, wait_until='networkidle')
+            
+            # Authentication flow
+            if not await self._handle_auth0_login(page):
+                raise Exception("Auth0 login failed")
+            
+            if not await self._handle_sharp_start_selection(page):
+                raise Exception("Sharp-Start selection failed")
+            
+            if not await self._handle_sharp_login(page):
+                raise Exception("Sharp login failed")
+            
+            if not await self._wait_for_dashboard(page):
+                raise Exception("Dashboard redirect failed")
+            
+            # Token extraction
+            logger.info("Step 6: Extracting authentication token...")
+            # Returns as soon as the interceptor catches a token
+            await self._wait_for_token(5000)
+            
+            current_url = page.url
+            logger.info(f"Current URL: {current_url}")
+            
+            # Check for authorization code
+            code_match = _CODE_RE.search(current_url)
+            if code_match:
+                auth_code = code_match.group(1)
+                logger.info(f"Authorization code found: {auth_code[:20]}...")
+            
+            # Priority 1: Already intercepted token
+            if self.intercepted_token:
+                logger.info(f"Token already intercepted: {self.intercepted_token[:50]}...")
+                return self._create_success_response(self.intercepted_token, 'api_request_interception', page)
+            
+            # Priority 2: Trigger API calls
+            if await self._trigger_api_calls(page):
+                logger.info(f"Token intercepted after triggering API calls!")
+                return self._create_success_response(self.intercepted_token, 'api_call_triggered', page)
+            
+            # Priority 3: URL fragment
+            if '#' in current_url:
+                fragment = current_url.split('#')[1]
+                token_match = _ACCESS_TOKEN_RE.search(fragment)
+                if token_match:
+                    token = token_match.group(1)
+                    logger.info(f"Access token found in URL fragment: {token[:50]}...")
+                    return self._create_success_response(token, 'url_fragment', page)
+            
+            # Priority 4: Browser storage
+            token = await self._extract_token_from_storage(page)
+            if token:
+                return self._create_success_response(token, 'browser_storage', page)
+            
+            # Priority 5: Cookies
+            token = await self._extract_token_from_cookies(context)
+            if token:
+                return self._create_success_response(token, 'cookies', page)
+            
+            # Fallback: Use intercepted token if available
+            if self.intercepted_token:
+                return self._create_success_response(self.intercepted_token, 'intercepted_fallback', page)
+            
+            # No token found but have auth code
+            if code_match:
                 return {
                     'success': False,
-                    'error': str(e),
+                    'token': None,
+                    'authorization_code': auth_code,
+                    'message': 'Login successful but JWT token not found. Authorization code available.',
                     'extracted_at': datetime.now().isoformat(),
-                    'url': page.url if 'page' in locals() else 'unknown'
+                    'url': page.url,
+                    'final_page_title': await page.title()
                 }
-            finally:
-                await browser.close()
+            
+            return self._create_failure_response('No token found', page)
+            
+        except Exception as e:
+            logger.error(f"Error during login process: {e}")
+            try:
+                await page.screenshot(path='debug_error.png')
+            except:
+                pass
+            return {
+                'success': False,
+                'error': str(e),
+                'extracted_at': datetime.now().isoformat(),
+                'url': page.url if 'page' in locals() else 'unknown'
+            }
+        finally:
+            await context.close()
 
     def _create_success_response(self, token: str, source: str, page: Page) -> Dict:
         """Create a standardized success response."""
@@ -557,19 +690,10 @@ class AuthTokenExtractor:
 
     def test_api_with_token(self, token: str) -> Dict:
         """Test the API endpoint with the extracted token."""
-        headers = {
-            'accept': 'application/json, text/plain, */*',
-            'accept-language': 'en-US,en;q=0.6',
-            'authorization': f'Bearer {token}',
-            'content-type': 'application/json',
-            'origin': 'https://dev7-smartoffice.sharpb2bcloud.com',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-            'x-app-version': '4.16.0-SNAPSHOT-20250717-110003',
-            'x-time-zone': '+05:30'
-        }
-        
         try:
-            response = requests.get(self.api_url, headers=headers, timeout=30)
+            response = self._session.get(
+                self.api_url, headers={'authorization': f'Bearer {token}'}, timeout=30
+            )
             logger.info(f"API response status code: {response.status_code}")
             return {
                 'success': response.status_code == 200,
@@ -592,13 +716,33 @@ class AuthTokenExtractor:
             'saved_at': datetime.now().isoformat()
         }
         
-        with open(self.token_file, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Serialize once and swap in atomically so a killed process never leaves a half-written file
+        tmp_file = self.token_file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(data, separators=(',', ':')))
+        tmp_file.replace(self.token_file)
         
         logger.info("Token data saved to %s", self.token_file)
 
-    async def run(self) -> Dict:
-        """Main method to run the complete token extraction process."""
+    async def run(self, force: bool = False) -> Dict:
+        """
+        Main method to run the complete token extraction process.
+        Returns the stored token without logging in if it is still valid, unless force is set.
+        
+        Concurrent callers share the in-flight run instead of starting a second login.
+        """
+        if self._run_task is None or self._run_task.done():
+            self._run_task = asyncio.create_task(self._run(force))
+        # Shield so one cancelled caller doesn't abort the shared login
+        return await asyncio.shield(self._run_task)
+
+    async def _run(self, force: bool) -> Dict:
+        """Run one extraction; only ever called through run()."""
+        if not force:
+            token = get_stored_token(str(self.token_file))
+            if token and not is_jwt_expired(token):
+                logger.info("Stored token is still valid; skipping extraction")
+                return {'success': True, 'token': token, 'api_test': None, 'source': 'cache'}
+        
         logger.info("Starting Auth0 token extraction process")
         
         # Extract token
@@ -609,7 +753,7 @@ class AuthTokenExtractor:
             
             # Test API with token
             logger.info("Testing API with extracted token")
-            api_result = self.test_api_with_token(token_result['token'])
+            api_result = await asyncio.to_thread(self.test_api_with_token, token_result['token'])
             
             if api_result['success']:
                 logger.info("API test successful")
@@ -630,11 +774,41 @@ class AuthTokenExtractor:
             return token_result
 
 
+# Per-process state for running extractions in a ProcessPoolExecutor worker,
+# keeping Playwright's event loop isolated from the MCP server's loop
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_extractor: Optional[AuthTokenExtractor] = None
+
+
+def init_extraction_worker() -> None:
+    """Pool initializer: create the worker's long-lived event loop and extractor."""
+    global _worker_loop, _worker_extractor
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_extractor = AuthTokenExtractor()
+
+
+def run_extraction_in_worker() -> Dict:
+    """Run one token extraction on the worker's event loop."""
+    if _worker_loop is None:
+        init_extraction_worker()
+    # The server only asks once its own (skewed) expiry check has failed
+    return _worker_loop.run_until_complete(_worker_extractor.run(force=True))
+
+
+def close_extraction_worker() -> None:
+    """Close the worker's pooled browser before the pool shuts down."""
+    if _worker_loop is not None and _worker_extractor is not None:
+        _worker_loop.run_until_complete(_worker_extractor.close())
+
+
 async def main():
     """Main entry point."""
     extractor = AuthTokenExtractor()
-    result = await extractor.run()
-    return result
+    try:
+        return await extractor.run()
+    finally:
+        await extractor.close()
 
 if __name__ == "__main__":
     token_file = os.getenv('TOKEN_FILE', 'auth_token.json')
@@ -3,10 +3,14 @@ Entry point for running the MCP RMM server as a standalone process.
 This allows the server to be started with `python -m mcp_rmm.server` or imported as a module.
 """
 
-from auth_mcp_server import mcp
+from auth_mcp_server import mcp, shutdown
 
 def run():
     """Run the MCP server."""
-    mcp.run(transport="sse")
+    try:
+        mcp.run(transport="sse")
+    finally:
+        # The lifespan runs per SSE session; shared resources are released once here
+        shutdown()
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -199,10 +199,10 @@ function Show-NextSteps {
     Write-Host ""
     Write-Host "2. Test the authentication:" -ForegroundColor Yellow
     if (Test-Command "uv") {
-        Write-Host "   uv run python -c `"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run())`""
+        Write-Host "   uv run python -c `"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run(force=True))`""
     }
     else {
-        Write-Host "   python -c `"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run())`""
+        Write-Host "   python -c `"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run(force=True))`""
     }
     
     Write-Host ""
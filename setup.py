@@ -4,187 +4,430 @@ MCP-RMM Setup Script
 Automates the installation and configuration of the MCP-RMM server.
 """
 
+import argparse
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
 import os
+import re
 import sys
 import subprocess
 import shutil
+import tempfile
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
-def run_command(command, description, check=True):
-    """Run a command and handle errors."""
-    print(f"🔄 {description}...")
+def find_uv():
+    """Locate uv on PATH, falling back to the installer's default locations."""
+    found = shutil.which("uv")
+    if found:
+        return found
+    # A freshly installed uv may not be on this process's PATH yet
+    exe = "uv.exe" if os.name == 'nt' else "uv"
+    for candidate in (Path.home() / ".local" / "bin" / exe, Path.home() / ".cargo" / "bin" / exe):
+        if candidate.is_file():
+            return str(candidate)
+    return None
+
+
+# Resolved once at startup (and again after installing uv) rather than per call
+UV_PATH = find_uv()
+
+# Output is always piped, so Windows children need no console window of their own
+_CREATION_FLAGS = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+
+# Setup steps run concurrently; keep their status lines from interleaving
+_print_lock = threading.Lock()
+
+# On a terminal, command output is shown on one line that is rewritten in place
+_LIVE_OUTPUT = sys.stdout.isatty()
+_live_width = 0
+
+
+def _clear_live_line():
+    """Blank out the in-place command output line, if one is showing."""
+    global _live_width
+    if _live_width:
+        sys.stdout.write("\r" + " " * _live_width + "\r")
+        _live_width = 0
+
+
+def log(message):
+    """Print a status line without interleaving with other setup threads."""
+    with _print_lock:
+        _clear_live_line()
+        print(message)
+
+
+def show_command_output(line):
+    """Show one line of command output, overwriting the previous one on a terminal."""
+    global _live_width
+    if not _LIVE_OUTPUT:
+        log(f"   {line}")
+        return
+    line = f"   {line}"[:shutil.get_terminal_size().columns - 1]
+    with _print_lock:
+        # Pad over whatever is left of a longer previous line
+        sys.stdout.write("\r" + line.ljust(_live_width))
+        sys.stdout.flush()
+        _live_width = len(line)
+
+
+# Fingerprints of the inputs each phase last succeeded with, so reruns can skip it
+STATE_FILE = Path(".setup_state.json")
+DEPENDENCY_INPUTS = ("pyproject.toml", "uv.lock", ".venv/pyvenv.cfg")
+VERIFY_INPUTS = DEPENDENCY_INPUTS + ("auth_mcp_server.py", "auth_playwright.py")
+
+
+def load_setup_state():
+    """Load the recorded phase fingerprints, or an empty dict."""
+    try:
+        return json.loads(STATE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def setup_fingerprint(inputs):
+    """Hash the interpreter, uv binary and input files' mtimes/sizes for a phase."""
+    parts = [sys.version, sys.platform, sys.prefix, UV_PATH]
+    for path in filter(None, (UV_PATH, *inputs)):
+        try:
+            st = os.stat(path)
+            parts.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            parts.append((path, None))
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def run_cached_phase(phase, step, inputs, force=False):
+    """Run step() unless it already succeeded with the same inputs, recording success."""
+    if not force and load_setup_state().get(phase) == setup_fingerprint(inputs):
+        log(f"✅ {phase} unchanged since the last successful run, skipping")
+        return True
+    if not step():
+        return False
+    # Fingerprint after the step, which may itself have created inputs such as .venv
+    state = load_setup_state()
+    state[phase] = setup_fingerprint(inputs)
     try:
-        result = subprocess.run(command, shell=True, check=check, capture_output=True, text=True)
-        if result.returncode == 0:
-            print(f"✅ {description} completed successfully")
+        STATE_FILE.write_text(json.dumps(state, indent=2))
+    except OSError as e:
+        log(f"⚠️  Could not save {STATE_FILE}: {e}")
+    return True
+
+
+def run_command(command, description, shell=False):
+    """Run a command (an argv list, or a string when shell=True), streaming its output."""
+    log(f"🔄 {description}...")
+    # Only the tail is kept for the failure report; the rest goes straight to the console
+    tail = deque(maxlen=50)
+    try:
+        with subprocess.Popen(
+            command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+            creationflags=_CREATION_FLAGS
+        ) as proc:
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                show_command_output(line)
+                tail.append(line)
+        if proc.returncode == 0:
+            log(f"✅ {description} completed successfully")
             return True
         else:
-            print(f"❌ {description} failed: {result.stderr}")
+            log(f"❌ {description} failed:\n" + "\n".join(tail))
             return False
-    except subprocess.CalledProcessError as e:
-        print(f"❌ {description} failed: {e}")
+    except OSError as e:
+        log(f"❌ {description} failed: {e}")
         return False
 
 
 def check_python_version():
     """Check if Python version meets requirements."""
-    print("🔍 Checking Python version...")
-    version = sys.version_info
-    if version.major >= 3 and version.minor >= 11:
-        print(f"✅ Python {version.major}.{version.minor}.{version.micro} is compatible")
+    log("🔍 Checking Python version...")
+    ver = sys.version_info
+    version = f"{ver.major}.{ver.minor}.{ver.micro}"
+    if ver >= (3, 11):
+        log(f"✅ Python {version} is compatible")
         return True
     else:
-        print(f"❌ Python {version.major}.{version.minor}.{version.micro} is not compatible. Python 3.11+ required.")
+        log(f"❌ Python {version} is not compatible. Python 3.11+ required.")
         return False
 
 
-def check_uv_installed():
-    """Check if uv package manager is installed."""
-    print("🔍 Checking for uv package manager...")
-    if shutil.which("uv"):
-        print("✅ uv package manager found")
+def download_uv_installer():
+    """Download the uv install script to a temporary file, returning its path or None."""
+    url = "https://astral.sh/uv/install.ps1" if os.name == 'nt' else "https://astral.sh/uv/install.sh"
+    fd, path = tempfile.mkstemp(prefix="uv-install-", suffix=Path(url).suffix)
+    os.close(fd)
+    try:
+        urllib.request.urlretrieve(url, path)
+        return path
+    except OSError as e:
+        log(f"⚠️  Could not download the uv installer: {e}")
+        os.unlink(path)
+        return None
+
+
+def check_uv_installed(installer=None):
+    """Check if uv package manager is installed.
+    
+    installer is an optional future for download_uv_installer(), started
+    early so the download overlaps the other checks.
+    """
+    global UV_PATH
+    log("🔍 Checking for uv package manager...")
+    if UV_PATH:
+        log("✅ uv package manager found")
         return True
     else:
-        print("❌ uv package manager not found")
-        print("📝 Installing uv package manager...")
-        if os.name == 'nt':  # Windows
-            return run_command("powershell -c \"irm https://astral.sh/uv/install.ps1 | iex\"", "Installing uv on Windows")
+        log("❌ uv package manager not found")
+        log("📝 Installing uv package manager...")
+        script = installer.result() if installer else None
+        if script:
+            if os.name == 'nt':  # Windows
+                installed = run_command(["powershell", "-ExecutionPolicy", "ByPass", "-File", script], "Installing uv on Windows")
+            else:  # Unix-like
+                installed = run_command(["sh", script], "Installing uv on Unix")
+        elif os.name == 'nt':  # Windows
+            installed = run_command("powershell -c \"irm https://astral.sh/uv/install.ps1 | iex\"", "Installing uv on Windows", shell=True)
         else:  # Unix-like
-            return run_command("curl -LsSf https://astral.sh/uv/install.sh | sh", "Installing uv on Unix")
+            installed = run_command("curl -LsSf https://astral.sh/uv/install.sh | sh", "Installing uv on Unix", shell=True)
+        UV_PATH = find_uv()
+        return installed
+
+
+def venv_already_provisioned():
+    """Check whether we run inside a virtualenv that has every project dependency installed."""
+    if sys.prefix == sys.base_prefix:
+        return False
+    try:
+        import tomllib
+        requirements = tomllib.loads(Path("pyproject.toml").read_text())["project"]["dependencies"]
+    except (ImportError, OSError, KeyError, ValueError):
+        return False
+    for requirement in requirements:
+        name = re.split(r"[\s<>=!~;\[]", requirement, maxsplit=1)[0]
+        try:
+            importlib.metadata.distribution(name)
+        except importlib.metadata.PackageNotFoundError:
+            return False
+    return True
 
 
 def install_dependencies():
     """Install Python dependencies."""
-    print("📦 Installing Python dependencies...")
+    log("📦 Installing Python dependencies...")
+    
+    if venv_already_provisioned():
+        log(f"✅ Active virtualenv {sys.prefix} already has all dependencies")
+        return True
     
-    # Try uv first, fallback to pip
-    if shutil.which("uv"):
-        success = run_command("uv sync", "Installing dependencies with uv")
-        if success:
+    # Try uv sync first, then uv's pip interface, and plain pip as a last resort
+    if UV_PATH:
+        # A lockfile lets uv install without re-running the resolver; --locked
+        # (unlike --frozen) refuses a lock that no longer matches pyproject.toml
+        if Path("uv.lock").exists():
+            if run_command([UV_PATH, "sync", "--locked"], "Installing dependencies from uv.lock"):
+                return True
+            log("🔄 uv sync --locked failed (lockfile out of date?), re-resolving...")
+        if Path("uv.lock").exists() or Path("pyproject.toml").exists():
+            if run_command([UV_PATH, "sync"], "Installing dependencies with uv"):
+                return True
+            log("🔄 uv sync failed, trying uv pip...")
+        if run_command([UV_PATH, "pip", "install", "-e", "."], "Installing dependencies with uv pip"):
             return True
-        print("🔄 uv sync failed, trying pip...")
+        log("🔄 uv pip install failed, trying pip...")
     
     # Fallback to pip
-    return run_command("pip install -e .", "Installing dependencies with pip")
+    return run_command(["pip", "install", "-e", "."], "Installing dependencies with pip")
+
+
+def _playwright_browsers_dir():
+    """Return the directory Playwright downloads browsers into."""
+    override = os.environ.get("PLAYWRIGHT_BROWSERS_PATH")
+    if override:
+        # "0" means the browsers live inside the playwright package itself
+        return None if override == "0" else Path(override)
+    if os.name == 'nt':
+        return Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local")) / "ms-playwright"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "ms-playwright"
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "ms-playwright"
 
 
-def install_playwright_browsers():
+def _expected_firefox_revision():
+    """Return the Firefox revision the installed playwright package wants, if it can be found."""
+    candidates = [_venv_site_packages()]
+    spec = importlib.util.find_spec("playwright")
+    if spec and spec.submodule_search_locations:
+        candidates.append(Path(next(iter(spec.submodule_search_locations))).parent)
+    for site_packages in filter(None, candidates):
+        try:
+            browsers = json.loads((site_packages / "playwright" / "driver" / "package" / "browsers.json").read_text())
+        except (OSError, ValueError):
+            continue
+        for browser in browsers.get("browsers", []):
+            if browser.get("name") == "firefox":
+                return browser.get("revision")
+    return None
+
+
+def firefox_already_installed():
+    """Check whether Playwright's Firefox has already been fully downloaded."""
+    browsers_dir = _playwright_browsers_dir()
+    revision = _expected_firefox_revision()
+    # Without the wanted revision any firefox-* could be stale, so let Playwright decide
+    if browsers_dir is None or revision is None:
+        return False
+    # Playwright writes this marker only after a download has been unpacked completely
+    return (browsers_dir / f"firefox-{revision}" / "INSTALLATION_COMPLETE").exists()
+
+
+def install_playwright_browsers(force=False):
     """Install Playwright browsers."""
-    print("🌐 Installing Playwright browsers...")
+    log("🌐 Installing Playwright browsers...")
+    
+    if not force and firefox_already_installed():
+        log("✅ Firefox browser already installed (use --force to reinstall)")
+        return True
     
-    if shutil.which("uv"):
-        return run_command("uv run playwright install firefox", "Installing Firefox browser with uv")
+    if UV_PATH:
+        return run_command([UV_PATH, "run", "playwright", "install", "firefox"], "Installing Firefox browser with uv")
     else:
-        return run_command("playwright install firefox", "Installing Firefox browser with pip")
+        return run_command(["playwright", "install", "firefox"], "Installing Firefox browser with pip")
 
 
 def setup_environment_file():
     """Set up environment configuration file."""
-    print("⚙️  Setting up environment configuration...")
+    log("⚙️  Setting up environment configuration...")
     
     env_example = Path(".env.example")
     env_file = Path(".env")
     
     if env_example.exists():
         if not env_file.exists():
-            print("📝 Creating .env file from template...")
-            shutil.copy(env_example, env_file)
-            print("✅ .env file created")
-            print("📝 Please edit .env file with your actual configuration values")
+            log("📝 Creating .env file from template...")
+            shutil.copyfile(env_example, env_file)
+            log("✅ .env file created")
+            log("📝 Please edit .env file with your actual configuration values")
             return True
         else:
-            print("ℹ️  .env file already exists")
+            log("ℹ️  .env file already exists")
             return True
     else:
-        print("❌ .env.example template not found")
+        log("❌ .env.example template not found")
         return False
 
 
+def _venv_site_packages():
+    """Return the project .venv site-packages directory, whatever Python it was built with."""
+    venv = Path(".venv")
+    candidates = [venv / "Lib" / "site-packages"] if os.name == 'nt' else sorted(venv.glob("lib/python*/site-packages"))
+    return next((path for path in candidates if path.is_dir()), None)
+
+
 def verify_installation():
     """Verify the installation is working."""
-    print("🧪 Verifying installation...")
+    log("🧪 Verifying installation...")
     
-    # Check if the main module can be imported
+    # Import inside the target environment's own interpreter: this one may be a
+    # different Python and can see packages that the environment lacks
+    check_import = ["python", "-c", "import auth_mcp_server; print('✅ MCP server module imported successfully')"]
     try:
-        if shutil.which("uv"):
-            result = subprocess.run(
-                "uv run python -c \"import auth_mcp_server; print('✅ MCP server module imported successfully')\"",
-                shell=True, check=True, capture_output=True, text=True
-            )
-        else:
-            result = subprocess.run(
-                "python -c \"import auth_mcp_server; print('✅ MCP server module imported successfully')\"",
-                shell=True, check=True, capture_output=True, text=True
-            )
+        if UV_PATH:
+            check_import = [UV_PATH, "run", *check_import]
+        result = subprocess.run(check_import, check=True, capture_output=True, text=True, creationflags=_CREATION_FLAGS)
         
-        print(result.stdout.strip())
+        log(result.stdout.strip())
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Module import failed: {e}")
+    except (subprocess.CalledProcessError, OSError) as e:
+        log(f"❌ Module import failed: {e}")
         return False
 
 
 def print_next_steps():
     """Print next steps for the user."""
-    print("\n" + "="*60)
-    print("🎉 MCP-RMM Setup Complete!")
-    print("="*60)
-    
-    print("\n📝 Next Steps:")
-    print("1. Edit the .env file with your actual configuration:")
-    print("   - Auth0 login URL and credentials")
-    print("   - Sharp B2B Cloud API endpoints")
-    print("   - API subscription keys")
-    
-    print("\n2. Test the authentication:")
-    if shutil.which("uv"):
-        print("   uv run python -c \"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run())\"")
-    else:
-        print("   python -c \"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run())\"")
-    
-    print("\n3. Start the MCP server:")
-    if shutil.which("uv"):
-        print("   uv run python server.py")
-    else:
-        print("   python server.py")
-    
-    print("\n📚 For more information, see README.md")
-    print("🐛 For issues, visit: https://github.com/anupam-123/AI--based-firmware-upgradation-system/issues")
+    python = "uv run python" if UV_PATH else "python"
+    lines = [
+        "\n" + "="*60,
+        "🎉 MCP-RMM Setup Complete!",
+        "="*60,
+        "\n📝 Next Steps:",
+        "1. Edit the .env file with your actual configuration:",
+        "   - Auth0 login URL and credentials",
+        "   - Sharp B2B Cloud API endpoints",
+        "   - API subscription keys",
+        "\n2. Test the authentication:",
+        f"   {python} -c \"from auth_playwright import AuthTokenExtractor; import asyncio; asyncio.run(AuthTokenExtractor().run(force=True))\"",
+        "\n3. Start the MCP server:",
+        f"   {python} server.py",
+        "\n💡 To re-run only some phases, pass --skip-deps, --skip-browser, --skip-env or --skip-verify to setup.py",
+        "\n📚 For more information, see README.md",
+        "🐛 For issues, visit: https://github.com/anupam-123/AI--based-firmware-upgradation-system/issues",
+    ]
+    # One write for the whole block
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def main():
     """Main setup function."""
+    parser = argparse.ArgumentParser(description="Install and configure the MCP-RMM server.")
+    parser.add_argument("--force", action="store_true", help="redo every phase, even ones already completed")
+    parser.add_argument("--skip-deps", action="store_true", help="skip installing Python dependencies")
+    parser.add_argument("--skip-browser", action="store_true", help="skip installing the Playwright browser")
+    parser.add_argument("--skip-env", action="store_true", help="skip creating the .env file")
+    parser.add_argument("--skip-verify", action="store_true", help="skip the module import check")
+    args = parser.parse_args()
+    
     print("🚀 MCP-RMM Setup Script")
     print("="*40)
     
-    # Check prerequisites
-    if not check_python_version():
-        sys.exit(1)
-    
-    # Install uv if needed
-    if not check_uv_installed():
-        print("⚠️  Continuing without uv, using pip instead...")
-    
-    # Install dependencies
-    if not install_dependencies():
-        print("❌ Failed to install dependencies")
-        sys.exit(1)
-    
-    # Install Playwright browsers
-    if not install_playwright_browsers():
-        print("❌ Failed to install Playwright browsers")
-        sys.exit(1)
-    
-    # Setup environment file
-    if not setup_environment_file():
-        print("❌ Failed to setup environment file")
-        sys.exit(1)
-    
-    # Verify installation
-    if not verify_installation():
-        print("❌ Installation verification failed")
-        sys.exit(1)
+    # The uv installer download, the .env template copy and (once dependencies
+    # are in place) the browser install and import check all run side by side.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        installer = executor.submit(download_uv_installer) if not UV_PATH else None
+        try:
+            # Check prerequisites
+            if not check_python_version():
+                sys.exit(1)
+            
+            # Install uv if needed
+            if not check_uv_installed(installer):
+                log("⚠️  Continuing without uv, using pip instead...")
+        finally:
+            # Remove the downloaded script whether it was used or setup bailed out early
+            script = installer.result() if installer else None
+            if script:
+                Path(script).unlink(missing_ok=True)
+        
+        env_future = executor.submit(setup_environment_file) if not args.skip_env else None
+        
+        # Install dependencies
+        if not args.skip_deps and not run_cached_phase("Dependencies", install_dependencies, DEPENDENCY_INPUTS, args.force):
+            log("❌ Failed to install dependencies")
+            sys.exit(1)
+        
+        # Install Playwright browsers and verify installation
+        browsers_future = executor.submit(install_playwright_browsers, args.force) if not args.skip_browser else None
+        verify_ok = args.skip_verify or run_cached_phase("Verification", verify_installation, VERIFY_INPUTS, args.force)
+        
+        if browsers_future and not browsers_future.result():
+            log("❌ Failed to install Playwright browsers")
+            sys.exit(1)
+        
+        # Setup environment file
+        if env_future and not env_future.result():
+            log("❌ Failed to setup environment file")
+            sys.exit(1)
+        
+        if not verify_ok:
+            log("❌ Installation verification failed")
+            sys.exit(1)
     
     # Print next steps
     print_next_steps()